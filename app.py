@@ -1,17 +1,32 @@
 import asyncio
+import errno
+import functools
 import importlib.util
+import itertools
+import json
 import logging
 import os
 import re
 import shutil
+import stat
+import string
 import subprocess
 import tempfile
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import PlainTextResponse
+from fastapi.responses import Response
 from python_multipart.multipart import parse_options_header
 
-from converter import SUPPORTED_EXTENSIONS, convert, get_converter
+from converter import (
+    PANDOC_STDIN_FORMATS,
+    SUPPORTED_EXTENSIONS,
+    convert,
+    pandoc_stream_to_markdown,
+    start_conversion_workers,
+    start_pandoc_server,
+    stop_pandoc_server,
+)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("converter")
@@ -20,50 +35,259 @@ MAX_UPLOAD_SIZE = int(os.environ.get("MAX_UPLOAD_SIZE", 10 * 1024 * 1024))  # 10
 CONVERSION_TIMEOUT = int(os.environ.get("CONVERSION_TIMEOUT", 120))
 MAX_CONCURRENT_CONVERSIONS = int(os.environ.get("MAX_CONCURRENT_CONVERSIONS", 1))
 MAX_QUEUED_CONVERSIONS = int(os.environ.get("MAX_QUEUED_CONVERSIONS", 5))
+DISCONNECT_CHECK_INTERVAL = 2.0  # seconds between client disconnect checks
+# Allowance for boundaries, part headers and the filename field on top of the
+# file itself when judging a request by its Content-Length.
+MULTIPART_OVERHEAD = 64 * 1024
+
+
+def _private_upload_dir(path: str) -> str:
+    """Create path as a 0700 directory, or check that an existing one is private.
+
+    It usually sits in a world-writable parent (/tmp, /dev/shm), where another
+    local user could pre-create it (or a symlink) to read or swap uploads.
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode):
+        raise RuntimeError(f"Upload directory {path} is not a directory")
+    if st.st_uid != os.geteuid():
+        raise RuntimeError(f"Upload directory {path} is owned by uid {st.st_uid}")
+    if st.st_mode & 0o077:
+        raise RuntimeError(
+            f"Upload directory {path} has mode {stat.S_IMODE(st.st_mode):o}; expected 700"
+        )
+    return path
+
+
+# Point CONVERTER_TMPDIR at a tmpfs (e.g. /dev/shm/converter) to keep uploads
+# in memory.  It isn't the default: container runtimes give /dev/shm only
+# 64 MB unless told otherwise, less than a full queue of maximum-size uploads.
+UPLOAD_DIR = _private_upload_dir(
+    os.environ.get("CONVERTER_TMPDIR") or os.path.join(tempfile.gettempdir(), "converter")
+)
+_upload_counter = itertools.count()
+# Anonymous O_TMPFILE spools need /proc to be linked under a name later.  The
+# directory fd makes os.link use linkat(AT_SYMLINK_FOLLOW) on the /proc path.
+_UPLOAD_DIR_FD = None
+if hasattr(os, "O_TMPFILE") and os.path.isdir("/proc/self/fd"):
+    _UPLOAD_DIR_FD = os.open(UPLOAD_DIR, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC)
 
 conversion_semaphore = asyncio.Semaphore(MAX_CONCURRENT_CONVERSIONS)
-# Bounds total in-flight requests (active + queued)
-_queue_slots = asyncio.Semaphore(MAX_CONCURRENT_CONVERSIONS + MAX_QUEUED_CONVERSIONS)
+# Bounds total in-flight requests (active + queued).  A plain counter is
+# enough: the check and increment never straddle an await.
+MAX_INFLIGHT_REQUESTS = MAX_CONCURRENT_CONVERSIONS + MAX_QUEUED_CONVERSIONS
+_inflight = 0
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    start_conversion_workers()
+    start_pandoc_server(CONVERSION_TIMEOUT)  # no-op unless PANDOC_SERVER_PORT is set
+    yield
+    stop_pandoc_server()
+
+
+app = FastAPI(title="Markdown Converter Image", lifespan=lifespan)
+
+# Tool availability cannot change while the process runs; probe once and
+# serialize the /health body up front so liveness checks are a plain write.
+_HEALTH_BODY = json.dumps({
+    "status": "ok",
+    "pandoc": shutil.which("pandoc") is not None,
+    "markitdown": importlib.util.find_spec("markitdown") is not None,
+}).encode()
 
-app = FastAPI(title="Markdown Converter Image")
 
-SAFE_FILENAME_RE = re.compile(r"^[a-zA-Z0-9._-]+$")
+class _SafeFilenameTable(dict):
+    """str.translate table: whitelisted chars map to themselves, all others to '_'."""
+
+    def __missing__(self, codepoint):
+        return "_"
+
+
+_SAFE_FILENAME_TABLE = _SafeFilenameTable(
+    (ord(c), c) for c in string.ascii_letters + string.digits + "._-"
+)
 
 
 def sanitize_filename(filename: str) -> str:
     """Sanitize filename to prevent path traversal and injection."""
-    name = os.path.basename(filename)
-    if not name or not SAFE_FILENAME_RE.match(name):
-        # Strip unsafe characters, keep only safe ones
-        name = re.sub(r"[^a-zA-Z0-9._-]", "_", name)
+    # Replace unsafe characters in a single C-level pass
+    name = os.path.basename(filename).translate(_SAFE_FILENAME_TABLE)
     if not name:
         raise ValueError("Invalid filename")
     return name
 
 
+def _resolve_upload_name(form_filename: str, cd_filename: str) -> tuple[str, str]:
+    """Return the (sanitized filename, lowercased extension) for an upload.
+
+    The ``filename`` form field wins over the file part's own filename.
+    Raises HTTPException 400 for a missing or unusable name and 415 for an
+    unsupported extension.
+    """
+    raw_name = form_filename or cd_filename
+    if not raw_name:
+        raise HTTPException(status_code=400, detail="Missing filename")
+
+    try:
+        safe_name = sanitize_filename(raw_name)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid filename")
+
+    # A leading dot marks a dotfile, not an extension (".docx" has none)
+    dot = safe_name.rfind(".")
+    ext = safe_name[dot:].lower() if dot > 0 else ""
+
+    if ext not in SUPPORTED_EXTENSIONS:
+        raise HTTPException(
+            status_code=415,
+            detail=f"Unsupported file extension: {ext or '(none)'}",
+        )
+    return safe_name, ext
+
+
+# One parameter of a multipart part's Content-Disposition.  Every parameter
+# is matched in order, so a quoted value (which may contain ';' and
+# backslash escapes) is never rescanned for parameters of its own.
+_CD_PARAM_RE = re.compile(rb';\s*([^=;\s]+)\s*=\s*(?:"((?:[^"\\]|\\.)*)"|([^;]*))')
+
+
+def _content_disposition_params(cd: bytes) -> tuple[str, str]:
+    """Return the (name, filename) parameters of a part's Content-Disposition."""
+    params = {}
+    for key, quoted, bare in _CD_PARAM_RE.findall(cd):
+        # Parameter names are case-insensitive (RFC 7578 / RFC 6266)
+        key = key.lower()
+        if key not in (b"name", b"filename"):
+            continue
+        if quoted or not bare:
+            params[key] = quoted.replace(b"\\\\", b"\\").replace(b'\\"', b'"')
+        else:
+            params[key] = bare.strip()
+    fname = params.get(b"filename", b"")
+    # Old IE sends the full client path; keep only the last component
+    if fname[1:3] == b":\\" or fname[:2] == b"\\\\":
+        fname = fname.rsplit(b"\\", 1)[-1]
+    return (
+        params.get(b"name", b"").decode("utf-8", errors="replace"),
+        fname.decode("utf-8", errors="replace"),
+    )
+
+
+def _open_spool(upload_id: str):
+    """Open a file in UPLOAD_DIR to spool an upload into; return (file, path).
+
+    Where O_TMPFILE is supported the file is anonymous (path is None): it
+    has no directory entry to clean up, and a crashed worker can't orphan
+    it.  Otherwise it is a regular file under a placeholder name.
+    """
+    if _UPLOAD_DIR_FD is not None:
+        try:
+            fd = os.open(".", os.O_TMPFILE | os.O_RDWR | os.O_CLOEXEC, 0o600, dir_fd=_UPLOAD_DIR_FD)
+        except OSError:
+            pass  # filesystem without O_TMPFILE support
+        else:
+            return open(fd, "w+b", buffering=1 << 20), None
+    path = os.path.join(UPLOAD_DIR, f"{upload_id}.upload")
+    return open(path, "w+b", buffering=1 << 20), path
+
+
+def _spool_failed(e: OSError) -> HTTPException:
+    """Map a failure to store an upload to a server-side error, not a 422."""
+    logger.error("[Converter] Could not store upload: %s", e)
+    if e.errno in (errno.ENOSPC, errno.EDQUOT):
+        return HTTPException(status_code=507, detail="Insufficient storage for upload")
+    return HTTPException(status_code=500, detail="Could not store upload")
+
+
+def _remove_upload(path: str) -> None:
+    """Delete a temp upload, ignoring files that are already gone."""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def _discard_upload(upload_file, path: str | None, fut: asyncio.Future) -> None:
+    """Done-callback for an abandoned conversion: release its upload."""
+    if not fut.cancelled():
+        fut.exception()  # retrieve it so asyncio doesn't log it as unhandled
+    upload_file.close()
+    if path:
+        _remove_upload(path)
+
+
+async def _watch_disconnect(request: Request) -> None:
+    """Return once the client has disconnected."""
+    while not await request.is_disconnected():
+        await asyncio.sleep(DISCONNECT_CHECK_INTERVAL)
+
+
+async def _wait_unless_disconnected(request: Request, fut: asyncio.Future) -> bool:
+    """Wait for fut; return False if the client disconnects first.
+
+    fut is raced against a disconnect watcher, so the caller wakes up the
+    moment it completes instead of on a polling timer.  On disconnect fut
+    is left pending for the caller to deal with.
+    """
+    watcher = asyncio.create_task(_watch_disconnect(request))
+    try:
+        await asyncio.wait({fut, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+    return fut.done()
+
+
+async def _acquire_conversion_slot(request: Request) -> bool:
+    """Wait for a conversion slot; return False if the client disconnects first."""
+    if not conversion_semaphore.locked():
+        await conversion_semaphore.acquire()
+        return True
+
+    acquire = asyncio.create_task(conversion_semaphore.acquire())
+    try:
+        acquired = await _wait_unless_disconnected(request, acquire)
+    except BaseException:
+        if acquire.done():
+            conversion_semaphore.release()
+        else:
+            acquire.cancel()
+        raise
+    if not acquired:
+        acquire.cancel()
+    return acquired
+
+
 @app.get("/health")
 async def health():
-    pandoc_ok = shutil.which("pandoc") is not None
-    markitdown_ok = importlib.util.find_spec("markitdown") is not None
-
-    return {"status": "ok", "pandoc": pandoc_ok, "markitdown": markitdown_ok}
+    return Response(content=_HEALTH_BODY, media_type="application/json")
 
 
 @app.post("/convert")
 async def convert_file(request: Request):
+    global _inflight
     # ── 1. Validate filename from Content-Disposition or query before reading body ──
     content_type = request.headers.get("content-type", "")
     if "multipart/form-data" not in content_type:
         raise HTTPException(status_code=400, detail="Expected multipart/form-data")
 
+    # Requests declaring a body well past the limit never get their body read;
+    # chunked uploads without Content-Length are caught while streaming.
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > MAX_UPLOAD_SIZE + MULTIPART_OVERHEAD:
+        raise HTTPException(status_code=413, detail="File too large")
+
     # ── 2. Reject immediately if the queue is full — before reading body ──
-    if _queue_slots.locked():
+    if _inflight >= MAX_INFLIGHT_REQUESTS:
         raise HTTPException(status_code=429, detail="Too many conversion requests queued")
 
-    await _queue_slots.acquire()
-    tmp_dir = None
+    _inflight += 1
+    tmp_path = None
+    upload_file = None
     try:
-        # ── 3. Stream multipart body, accumulate file bytes in memory ──
+        # ── 3. Stream multipart body, spooling file bytes straight to disk ──
         _, params = parse_options_header(content_type)
         boundary = params.get(b"boundary")
         if not boundary:
@@ -73,7 +297,8 @@ async def convert_file(request: Request):
 
         current_field = None
         cd_filename = None  # filename from Content-Disposition
-        file_data = bytearray()
+        # pid + counter keeps names unique across workers without a mkdir
+        upload_id = f"{os.getpid()}-{next(_upload_counter)}"
         file_size = 0
         form_fields = {}
         # Buffers for accumulating header field/value across split callbacks
@@ -106,17 +331,19 @@ async def convert_file(request: Request):
             _hdr_value.extend(data[start:end])
 
         def on_headers_finished():
-            nonlocal current_field, cd_filename
+            nonlocal current_field, cd_filename, tmp_path, upload_file
             _flush_header()
             cd = _part_headers.get("content-disposition", b"")
             if cd:
-                _, vparams = parse_options_header(cd)
-                name = vparams.get(b"name", b"").decode("utf-8", errors="replace")
-                fname = vparams.get(b"filename", b"").decode("utf-8", errors="replace")
+                name, fname = _content_disposition_params(cd)
                 if name == "file":
                     current_field = "file"
                     if fname:
                         cd_filename = fname
+                    if upload_file is None:
+                        # The real filename may arrive in a later field, so spool
+                        # anonymously and give the file its name once it's known.
+                        upload_file, tmp_path = _open_spool(upload_id)
                 elif name:
                     current_field = name
 
@@ -127,7 +354,7 @@ async def convert_file(request: Request):
                 file_size += len(chunk)
                 if file_size > MAX_UPLOAD_SIZE:
                     raise HTTPException(status_code=413, detail="File too large")
-                file_data.extend(chunk)
+                upload_file.write(chunk)
             elif current_field:
                 form_fields[current_field] = form_fields.get(current_field, b"") + chunk
 
@@ -148,73 +375,72 @@ async def convert_file(request: Request):
         }
         parser = multipart_mod.MultipartParser(boundary, callbacks)
 
-        async for chunk in request.stream():
-            parser.write(chunk)
-        parser.finalize()
+        try:
+            async for chunk in request.stream():
+                parser.write(chunk)
+            parser.finalize()
+        except OSError as e:
+            raise _spool_failed(e)
 
         # ── 4. Resolve filename and validate ──
         form_filename = form_fields.get("filename", b"").decode("utf-8", errors="replace")
 
-        if not file_data:
+        if not file_size:
             raise HTTPException(status_code=400, detail="Missing file upload")
 
-        raw_name = form_filename or cd_filename
-        if not raw_name:
-            raise HTTPException(status_code=400, detail="Missing filename")
-
-        try:
-            safe_name = sanitize_filename(raw_name)
-        except ValueError:
-            raise HTTPException(status_code=400, detail="Invalid filename")
-
-        _, ext = os.path.splitext(safe_name)
-        ext = ext.lower()
-
-        if not ext or ext not in SUPPORTED_EXTENSIONS:
-            raise HTTPException(
-                status_code=415,
-                detail=f"Unsupported file extension: {ext or '(none)'}",
-            )
+        safe_name, ext = _resolve_upload_name(form_filename, cd_filename)
 
         logger.info("[Converter] Converting %s (%s, %d bytes)", safe_name, ext, file_size)
 
-        # ── 5. Write to disk with correct filename for converter ──
-        tmp_dir = tempfile.mkdtemp()
-        tmp_path = os.path.join(tmp_dir, safe_name)
-        with open(tmp_path, "wb") as f:
-            f.write(file_data)
-        del file_data  # free memory before conversion
+        # ── 5. Pipe stdin-capable formats straight to Pandoc; others need the
+        #       upload renamed to its real filename for the converter ──
+        try:
+            if ext in PANDOC_STDIN_FORMATS:
+                upload_file.seek(0)  # also flushes buffered writes
+                job = (pandoc_stream_to_markdown, upload_file, ext, CONVERSION_TIMEOUT)
+            else:
+                named = f"{upload_id}-{safe_name}"
+                named_path = os.path.join(UPLOAD_DIR, named)
+                if tmp_path is None:
+                    upload_file.flush()
+                    os.link(f"/proc/self/fd/{upload_file.fileno()}", named, dst_dir_fd=_UPLOAD_DIR_FD)
+                else:
+                    os.rename(tmp_path, named_path)
+                upload_file.close()
+                tmp_path = named_path
+                job = (convert, tmp_path, ext, CONVERSION_TIMEOUT)
+        except OSError as e:
+            raise _spool_failed(e)
 
         # ── 6. Wait for a conversion slot ──
-        while True:
-            try:
-                await asyncio.wait_for(conversion_semaphore.acquire(), timeout=1.0)
-                break
-            except asyncio.TimeoutError:
-                if await request.is_disconnected():
-                    logger.info("[Converter] Client disconnected while queued: %s", safe_name)
-                    return PlainTextResponse(content="", status_code=499)
+        if not await _acquire_conversion_slot(request):
+            logger.info("[Converter] Client disconnected while queued: %s", safe_name)
+            return Response(status_code=499)
 
+        task = None
         try:
-            # Run conversion in a thread; periodically check for disconnect
-            loop = asyncio.get_event_loop()
-            task = loop.run_in_executor(None, convert, tmp_path, ext, CONVERSION_TIMEOUT)
-            while True:
-                done, _ = await asyncio.wait({task}, timeout=2.0)
-                if done:
-                    markdown = task.result()
-                    break
-                if await request.is_disconnected():
-                    logger.info("[Converter] Client disconnected during conversion: %s", safe_name)
-                    return PlainTextResponse(content="", status_code=499)
+            # Run conversion in a thread; bail out early if the client disconnects
+            task = asyncio.get_running_loop().run_in_executor(None, *job)
+            if not await _wait_unless_disconnected(request, task):
+                logger.info("[Converter] Client disconnected during conversion: %s", safe_name)
+                return Response(status_code=499)
+            markdown = task.result()
         finally:
             conversion_semaphore.release()
+            if task is not None and not task.done():
+                # The thread may not even have opened the upload yet; closing
+                # it now could hand its fd number to another request
+                task.add_done_callback(functools.partial(_discard_upload, upload_file, tmp_path))
+                upload_file = tmp_path = None
 
         # Free disk space immediately
-        shutil.rmtree(tmp_dir, ignore_errors=True)
-        tmp_dir = None
+        upload_file.close()
+        if tmp_path:
+            _remove_upload(tmp_path)
+            tmp_path = None
 
-        return PlainTextResponse(
+        # Converters return UTF-8 bytes, so the body goes out without re-encoding
+        return Response(
             content=markdown,
             media_type="text/markdown; charset=utf-8",
         )
@@ -224,14 +450,14 @@ async def convert_file(request: Request):
         raise HTTPException(status_code=415, detail=detail)
     except HTTPException:
         raise
-    except TimeoutError:
-        raise HTTPException(status_code=504, detail="Conversion timed out")
-    except subprocess.TimeoutExpired:
+    except (TimeoutError, subprocess.TimeoutExpired):
         raise HTTPException(status_code=504, detail="Conversion timed out")
     except Exception as e:
         logger.error("[Converter] Conversion failed: %s", str(e))
         raise HTTPException(status_code=422, detail=f"Conversion failed: {str(e)}")
     finally:
-        _queue_slots.release()
-        if tmp_dir:
-            shutil.rmtree(tmp_dir, ignore_errors=True)
+        _inflight -= 1
+        if upload_file is not None:
+            upload_file.close()
+        if tmp_path:
+            _remove_upload(tmp_path)
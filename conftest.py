@@ -0,0 +1,49 @@
+import importlib.util
+from unittest.mock import patch
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import MAX_INFLIGHT_REQUESTS, app
+
+
+def pytest_configure(config):
+    # pytest-xdist registers this itself; declare it here too so plain
+    # serial runs don't warn about an unknown marker.
+    config.addinivalue_line(
+        "markers", "xdist_group(name): run all tests in the group on one xdist worker",
+    )
+
+
+@pytest.fixture(scope="session")
+def client():
+    """One TestClient for the whole run.
+
+    Entering it once runs the app's lifespan (forkserver warm-up, optional
+    pandoc server) and starts the anyio portal a single time.  The portal
+    runs on uvloop when it is installed, as the production server does.
+    """
+    use_uvloop = importlib.util.find_spec("uvloop") is not None
+    with TestClient(app, backend_options={"use_uvloop": use_uvloop}) as c:
+        yield c
+
+
+@pytest.fixture
+def drained_queue():
+    """Occupy every in-flight slot so new /convert requests are rejected."""
+    with patch("app._inflight", MAX_INFLIGHT_REQUESTS):
+        yield
+
+
+@pytest.fixture
+def mock_run():
+    """converter.subprocess.run, patched for the duration of a test."""
+    with patch("converter.subprocess.run") as m:
+        yield m
+
+
+@pytest.fixture
+def mock_convert():
+    """The endpoint's convert(), patched for the duration of a test."""
+    with patch("app.convert") as m:
+        yield m
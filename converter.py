@@ -1,38 +1,65 @@
 import subprocess
+import base64
+import functools
+import itertools
+import json
 import logging
+import multiprocessing
+import multiprocessing.forkserver
 import os
 import re
 import shutil
-import sys
+import threading
+import traceback
+import urllib.error
+import urllib.request
+from typing import BinaryIO
 
 logger = logging.getLogger("converter")
 
 
-def _extract_exception_message(stderr: str) -> str:
+_EXCEPTION_LINE_RE = re.compile(rb'[\w.]+(?:Error|Exception|Failure):\s')
+# Continuation lines kept after the exception line in user-facing errors
+_MAX_TAIL_LINES = 32
+_MAX_STDERR_BYTES = 4096
+
+
+def _extract_exception_message(stderr: bytes) -> str:
     """Extract the final exception message from a Python traceback.
 
     Returns the human-readable error (e.g. 'File is not a zip file')
     instead of the full stack trace.  Captures multi-line messages like
     FileConversionException that list individual converter failures.
+    Works on the raw bytes; only the extracted message is decoded.
     """
     lines = stderr.strip().splitlines()
     # Find the last exception line and return everything from it onwards
     for i, line in enumerate(lines):
         stripped = line.strip()
-        if re.match(r'^[\w.]+(?:Error|Exception|Failure):\s', stripped):
+        if _EXCEPTION_LINE_RE.match(stripped):
             # Take this line + any continuation lines that follow
-            _, _, message = stripped.partition(': ')
-            tail = '\n'.join(l.strip() for l in lines[i + 1:] if l.strip())
-            full = f"{message}\n{tail}".strip() if tail else (message or stripped)
-            return full
+            _, _, message = stripped.partition(b': ')
+            tail = b'\n'.join(l.strip() for l in lines[i + 1:i + 1 + _MAX_TAIL_LINES] if l.strip())
+            full = (message + b'\n' + tail).strip() if tail else (message or stripped)
+            return full.decode("utf-8", errors="replace")
     # Fallback: return last non-empty line
-    non_empty = [l.strip() for l in lines if l.strip()]
-    return non_empty[-1] if non_empty else stderr.strip()
+    last = next((l.strip() for l in reversed(lines) if l.strip()), b"")
+    return last.decode("utf-8", errors="replace")
+
+
+def _stderr_text(stderr: bytes) -> str:
+    """Decode the head of a CLI converter's stderr for an error message."""
+    # Pandoc and antiword print the actual error first; the rest would only
+    # bloat the response.  (Worker tracebacks end with the error instead.)
+    return stderr[:_MAX_STDERR_BYTES].decode("utf-8", errors="replace").strip()
+
 
 # File magic bytes
 _OLE2_MAGIC = b'\xD0\xCF\x11\xE0\xA1\xB1\x1A\xE1'
 _ZIP_MAGIC = b'PK\x03\x04'
 _RTF_MAGIC = b'{\\rtf'
+# The first four bytes identify each container format we sniff for
+_MAGIC_FORMATS = {_OLE2_MAGIC[:4]: 'ole2', _ZIP_MAGIC: 'zip', _RTF_MAGIC[:4]: 'rtf'}
 # Modern Office formats (.xlsx, .pptx, .docx) are ZIP-based.
 # When password-protected, Office wraps them in an OLE2 encrypted container.
 _ZIP_BASED_EXTENSIONS = {".xlsx", ".pptx", ".docx"}
@@ -41,229 +68,383 @@ _ZIP_BASED_EXTENSIONS = {".xlsx", ".pptx", ".docx"}
 PANDOC_EXTENSIONS = {".rtf", ".odt", ".txt", ".docx"}
 MARKITDOWN_EXTENSIONS = {".pptx", ".xls", ".xlsx", ".pdf"}
 # .doc is handled separately with a fallback chain (see convert())
-SUPPORTED_EXTENSIONS = PANDOC_EXTENSIONS | MARKITDOWN_EXTENSIONS | {".doc"}
+SUPPORTED_EXTENSIONS = frozenset(PANDOC_EXTENSIONS | MARKITDOWN_EXTENSIONS | {".doc"})
+# Pandoc input formats for extensions that can be piped through stdin.
+# .docx is excluded: its heap-exhaustion fallback (MarkItDown) needs a file path.
+PANDOC_STDIN_FORMATS = {".rtf": "rtf", ".odt": "odt", ".txt": "markdown"}
 
 DEFAULT_TIMEOUT = 120
 PANDOC_MAX_HEAP = os.environ.get("PANDOC_MAX_HEAP", "128m")
 
+# Converter binaries, resolved once instead of walking $PATH per conversion.
+# Pandoc keeps its bare name when missing so the failure surfaces at exec time.
+_ANTIWORD_PATH: str | None = None
+_PANDOC_PATH = "pandoc"
+
+
+def refresh_converter_paths() -> None:
+    """Re-resolve the converter binaries on $PATH."""
+    global _ANTIWORD_PATH, _PANDOC_PATH
+    _ANTIWORD_PATH = shutil.which("antiword")
+    _PANDOC_PATH = shutil.which("pandoc") or "pandoc"
+
+
+refresh_converter_paths()
+
+# Optional long-lived `pandoc server` (see start_pandoc_server()).  When
+# enabled, Pandoc conversions skip the per-call Haskell RTS startup.
+PANDOC_SERVER_PORT = int(os.environ.get("PANDOC_SERVER_PORT") or 0)
+# Pandoc input formats the server path can name explicitly, keyed by extension
+_PANDOC_SERVER_FORMATS = {".docx": "docx", **PANDOC_STDIN_FORMATS}
+# Binary input formats must be base64-encoded in the server's JSON payload
+_PANDOC_BINARY_FORMATS = {"docx", "odt"}
+_pandoc_server: subprocess.Popen | None = None
+_pandoc_server_timeout = DEFAULT_TIMEOUT
+_pandoc_server_lock = threading.Lock()
+
 
-def antiword_to_markdown(input_path: str, timeout: int = DEFAULT_TIMEOUT) -> str:
-    """Convert a legacy .doc file to plain text using antiword CLI."""
+def start_pandoc_server(timeout: int = DEFAULT_TIMEOUT) -> None:
+    """Launch `pandoc server` on localhost if PANDOC_SERVER_PORT is set.
+
+    The server shares the CLI's heap ceiling, so a document that exhausts
+    it takes the server down; callers then fall back to the CLI and the
+    server is relaunched for the next conversion.
+    """
+    global _pandoc_server, _pandoc_server_timeout
+    if not PANDOC_SERVER_PORT:
+        return
+    with _pandoc_server_lock:
+        if _pandoc_server is not None and _pandoc_server.poll() is None:
+            return
+        logger.info("[Converter] Starting pandoc server on port %d", PANDOC_SERVER_PORT)
+        _pandoc_server = subprocess.Popen(
+            [_PANDOC_PATH, "server", "--port", str(PANDOC_SERVER_PORT), "--timeout", str(timeout),
+             "+RTS", f"-M{PANDOC_MAX_HEAP}", "-RTS"],
+            stdout=subprocess.DEVNULL,
+        )
+        _pandoc_server_timeout = timeout
+
+
+def stop_pandoc_server() -> None:
+    """Terminate the pandoc server started by start_pandoc_server(), if any."""
+    global _pandoc_server
+    with _pandoc_server_lock:
+        if _pandoc_server is None:
+            return
+        _pandoc_server.terminate()
+        try:
+            _pandoc_server.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            _pandoc_server.kill()
+        _pandoc_server = None
+
+
+def _pandoc_server_to_markdown(data: bytes, fmt: str, timeout: int) -> bytes | None:
+    """Convert via the pandoc server; return None if it is not reachable."""
+    server = _pandoc_server
+    if server is None:
+        return None
+    if fmt in _PANDOC_BINARY_FORMATS:
+        text = base64.b64encode(data).decode("ascii")
+    else:
+        text = data.decode("utf-8", errors="replace")
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{PANDOC_SERVER_PORT}/",
+        data=json.dumps({"text": text, "from": fmt, "to": "markdown", "wrap": "none"}).encode("utf-8"),
+        headers={"Content-Type": "application/json", "Accept": "text/plain"},
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.read()
+    except urllib.error.HTTPError as e:
+        detail = e.read().decode("utf-8", errors="replace").strip()
+        raise RuntimeError(f"Pandoc conversion failed: {detail}")
+    except (urllib.error.URLError, ConnectionError) as e:
+        logger.warning("[Converter] pandoc server unavailable, using CLI: %s", e)
+        if server.poll() is not None:
+            # Crashed (e.g. heap exhausted) — relaunch for the next conversion
+            start_pandoc_server(_pandoc_server_timeout)
+        return None
+
+
+def antiword_to_markdown(input_path: str, timeout: int = DEFAULT_TIMEOUT) -> bytes:
+    """Convert a legacy .doc file to UTF-8 plain text using antiword CLI."""
     result = subprocess.run(
-        ["antiword", input_path],
+        [_ANTIWORD_PATH or "antiword", input_path],
         capture_output=True,
         timeout=timeout,
     )
     if result.returncode != 0:
-        stderr = result.stderr.decode("utf-8", errors="replace").strip()
+        stderr = _stderr_text(result.stderr)
         raise RuntimeError(f"antiword conversion failed: {stderr}")
-    return result.stdout.decode("utf-8", errors="replace")
-
-
-def pandoc_to_markdown(input_path: str, timeout: int = DEFAULT_TIMEOUT) -> str:
-    """Convert a document to Markdown using Pandoc CLI."""
+    # antiword output is not guaranteed to be valid UTF-8; normalise it
+    return result.stdout.decode("utf-8", errors="replace").encode("utf-8")
+
+
+def pandoc_to_markdown(input_path: str, timeout: int = DEFAULT_TIMEOUT) -> bytes:
+    """Convert a document to UTF-8 Markdown using Pandoc CLI (or the pandoc server)."""
+    fmt = _PANDOC_SERVER_FORMATS.get(os.path.splitext(input_path)[1].lower())
+    if _pandoc_server is not None and fmt:
+        with open(input_path, "rb") as f:
+            markdown = _pandoc_server_to_markdown(f.read(), fmt, timeout)
+        if markdown is not None:
+            return markdown
     result = subprocess.run(
-        ["pandoc", "+RTS", f"-M{PANDOC_MAX_HEAP}", "-RTS",
-         input_path, "-t", "markdown", "--wrap=none"],
+        [_PANDOC_PATH, "+RTS", f"-M{PANDOC_MAX_HEAP}", "-RTS",
+         input_path, "-t", "markdown", "--wrap=none", "--quiet"],
         capture_output=True,
         timeout=timeout,
     )
     if result.returncode != 0:
-        stderr = result.stderr.decode("utf-8", errors="replace").strip()
+        stderr = _stderr_text(result.stderr)
         raise RuntimeError(f"Pandoc conversion failed: {stderr}")
-    return result.stdout.decode("utf-8", errors="replace")
+    return result.stdout
 
 
-def markitdown_to_markdown(input_path: str, timeout: int = DEFAULT_TIMEOUT) -> str:
-    """Convert a document to Markdown using MarkItDown in a subprocess.
+def pandoc_stream_to_markdown(stream: BinaryIO, extension: str, timeout: int = DEFAULT_TIMEOUT) -> bytes:
+    """Convert a document to Markdown by handing an open file to Pandoc's stdin.
 
-    Running in a subprocess ensures all memory is returned to the OS when
-    the conversion finishes, instead of fragmenting the main process heap.
+    The file needs no name or extension on disk, so uploads in formats
+    Pandoc can read from stdin (see PANDOC_STDIN_FORMATS) skip the rename
+    to their real filename.  stream must be positioned at the start.
     """
+    fmt = PANDOC_STDIN_FORMATS[extension.lower()]
+    if _pandoc_server is not None:
+        markdown = _pandoc_server_to_markdown(stream.read(), fmt, timeout)
+        if markdown is not None:
+            return markdown
+        stream.seek(0)
     result = subprocess.run(
-        [
-            sys.executable, "-c",
-            "import sys; "
-            "from markitdown import MarkItDown; "
-            "md = MarkItDown(); "
-            "r = md.convert(sys.argv[1]); "
-            "sys.stdout.buffer.write(r.text_content.encode('utf-8'))",
-            input_path,
-        ],
+        [_PANDOC_PATH, "+RTS", f"-M{PANDOC_MAX_HEAP}", "-RTS",
+         "-f", fmt, "-t", "markdown", "--wrap=none", "--quiet"],
+        stdin=stream,
         capture_output=True,
         timeout=timeout,
     )
     if result.returncode != 0:
-        stderr = result.stderr.decode("utf-8", errors="replace").strip()
-        clean_msg = _extract_exception_message(stderr)
-        logger.error("[Converter] MarkItDown stderr: %s", stderr)
-        raise RuntimeError(f"MarkItDown conversion failed: {clean_msg}")
-    return result.stdout.decode("utf-8", errors="replace")
+        stderr = _stderr_text(result.stderr)
+        raise RuntimeError(f"Pandoc conversion failed: {stderr}")
+    return result.stdout
 
 
-def xls_to_markdown(input_path: str, timeout: int = DEFAULT_TIMEOUT) -> str:
-    """Convert a legacy .xls file to Markdown using python-calamine in a subprocess.
+# MarkItDown and calamine conversions run in a child forked from a forkserver
+# that has already imported them: each conversion skips interpreter startup
+# and library imports, yet still exits afterwards so all of its memory goes
+# back to the OS.
+_worker_context = multiprocessing.get_context("forkserver")
+_worker_context.set_forkserver_preload(["converter", "markitdown", "python_calamine"])
+_WORKER_OK = b"ok"
+_WORKER_ERROR = b"error"
+_WORKER_ENCRYPTED = b"encrypted"
+_ENCRYPTED_MESSAGE = "File appears to be password-protected (encrypted Office document)"
 
-    xlrd 2.x rejects some .xls files with OLE2 FAT chain issues;
-    python-calamine (Rust-based) is more tolerant and faster.
+
+def start_conversion_workers() -> None:
+    """Start the forkserver now so the first conversion doesn't pay for its imports."""
+    multiprocessing.forkserver.ensure_running()
+
+
+def _worker_main(conn, target, input_path: str) -> None:
+    """Worker entry point: send back a status, then target's output or traceback.
+
+    Encrypted Office files are caught here rather than in the parent so the
+    header is read by the process that is about to open the file anyway.
     """
-    script = r'''
-import sys
-from python_calamine import CalamineWorkbook
-
-path = sys.argv[1]
-wb = CalamineWorkbook.from_path(path)
-parts = []
-for name in wb.sheet_names:
-    data = wb.get_sheet_by_name(name).to_python()
-    if not data:
-        continue
-    parts.append(f"## {name}")
-    for ri, row in enumerate(data):
-        cells = [str(c) if c is not None else "" for c in row]
-        parts.append("| " + " | ".join(cells) + " |")
-        if ri == 0:
-            parts.append("| " + " | ".join("---" for _ in cells) + " |")
-    parts.append("")
-sys.stdout.buffer.write("\n".join(parts).encode("utf-8"))
-'''
-    result = subprocess.run(
-        [sys.executable, "-c", script, input_path],
-        capture_output=True,
-        timeout=timeout,
-    )
-    if result.returncode != 0:
-        stderr = result.stderr.decode("utf-8", errors="replace").strip()
-        clean_msg = _extract_exception_message(stderr)
-        logger.error("[Converter] xls_to_markdown stderr: %s", stderr)
-        raise RuntimeError(f"XLS conversion failed: {clean_msg}")
-    return result.stdout.decode("utf-8", errors="replace")
+    try:
+        if _looks_encrypted(input_path, os.path.splitext(input_path)[1].lower()):
+            conn.send_bytes(_WORKER_ENCRYPTED)
+            return
+        result = target(input_path)
+    except BaseException:
+        conn.send_bytes(_WORKER_ERROR)
+        conn.send_bytes(traceback.format_exc().encode("utf-8", errors="replace"))
+    else:
+        conn.send_bytes(_WORKER_OK)
+        conn.send_bytes(result)
+    finally:
+        conn.close()
 
 
-def xlsx_to_markdown(input_path: str, timeout: int = DEFAULT_TIMEOUT) -> str:
-    """Convert an .xlsx file to Markdown using python-calamine in a subprocess.
+def _run_in_worker(target, input_path: str, timeout: int, label: str) -> bytes:
+    """Run target(input_path) in a fresh worker process and return its output.
 
-    Calamine (Rust-based) is fast, tolerant of unusual styles/fills that
-    trip up openpyxl, and already used for .xls files.
+    Raises subprocess.TimeoutExpired (after killing the worker) if it runs
+    past timeout, ValueError if input_path's extension names a ZIP-based
+    Office format but the file is encrypted, and RuntimeError if the
+    conversion fails or the worker dies.
     """
-    script = r'''
-import sys
-from python_calamine import CalamineWorkbook
-
-path = sys.argv[1]
-wb = CalamineWorkbook.from_path(path)
-parts = []
-for name in wb.sheet_names:
-    data = wb.get_sheet_by_name(name).to_python()
-    if not data:
-        continue
-    parts.append(f"## {name}")
-    for ri, row in enumerate(data):
-        cells = [str(c) if c is not None else "" for c in row]
-        parts.append("| " + " | ".join(cells) + " |")
-        if ri == 0:
-            parts.append("| " + " | ".join("---" for _ in cells) + " |")
-    parts.append("")
-sys.stdout.buffer.write("\n".join(parts).encode("utf-8"))
-'''
-    result = subprocess.run(
-        [sys.executable, "-c", script, input_path],
-        capture_output=True,
-        timeout=timeout,
+    recv_conn, send_conn = _worker_context.Pipe(duplex=False)
+    proc = _worker_context.Process(
+        target=_worker_main, args=(send_conn, target, input_path), daemon=True,
     )
-    if result.returncode != 0:
-        stderr = result.stderr.decode("utf-8", errors="replace").strip()
-        clean_msg = _extract_exception_message(stderr)
-        logger.error("[Converter] xlsx_to_markdown stderr: %s", stderr)
-        raise RuntimeError(f"XLSX conversion failed: {clean_msg}")
-    return result.stdout.decode("utf-8", errors="replace")
+    proc.start()
+    send_conn.close()
+    try:
+        if not recv_conn.poll(timeout):
+            raise subprocess.TimeoutExpired(label, timeout)
+        try:
+            status = recv_conn.recv_bytes()
+            payload = recv_conn.recv_bytes() if status != _WORKER_ENCRYPTED else b""
+        except EOFError:
+            proc.join()
+            raise RuntimeError(f"{label} conversion failed: worker exited with code {proc.exitcode}")
+    finally:
+        if proc.is_alive():
+            proc.kill()
+        proc.join()
+        recv_conn.close()
+    if status == _WORKER_ENCRYPTED:
+        raise ValueError(_ENCRYPTED_MESSAGE)
+    if status != _WORKER_OK:
+        clean_msg = _extract_exception_message(payload)
+        logger.error("[Converter] %s stderr: %s", label, payload.decode("utf-8", errors="replace").strip())
+        raise RuntimeError(f"{label} conversion failed: {clean_msg}")
+    return payload
+
+
+def _markitdown_worker(input_path: str) -> bytes:
+    from markitdown import MarkItDown
+    return MarkItDown().convert(input_path).text_content.encode("utf-8")
+
+
+def _is_blank_row(row: list) -> bool:
+    return row.count("") == len(row)
+
+
+def _calamine_worker(input_path: str) -> bytearray:
+    """Render every sheet of a workbook as a Markdown table."""
+    from python_calamine import CalamineWorkbook
+
+    out = bytearray()
+    wb = CalamineWorkbook.from_path(input_path)
+    for name in wb.sheet_names:
+        # iter_rows() starts at row 1 even when the used range starts lower;
+        # drop the leading blank rows so the header is the range's first row
+        # (to_python() skips that empty area too)
+        rows = itertools.dropwhile(_is_blank_row, wb.get_sheet_by_name(name).iter_rows())
+        header = next(rows, None)
+        if header is None:
+            continue
+        if out:
+            out += b"\n"
+        # calamine yields "" (never None) for empty cells, so str() is a
+        # per-cell C call with no Python-level branch
+        out += f"## {name}\n".encode("utf-8")
+        out += b"| "
+        out += " | ".join(map(str, header)).encode("utf-8")
+        out += b" |\n| "
+        out += b" | ".join([b"---"] * len(header))
+        out += b" |\n"
+        for row in rows:
+            out += b"| "
+            out += " | ".join(map(str, row)).encode("utf-8")
+            out += b" |\n"
+    return out
+
+
+def markitdown_to_markdown(input_path: str, timeout: int = DEFAULT_TIMEOUT) -> bytes:
+    """Convert a document to Markdown using MarkItDown in a worker process.
+
+    Running in a separate process ensures all memory is returned to the OS
+    when the conversion finishes, instead of fragmenting the main process heap.
+    """
+    return _run_in_worker(_markitdown_worker, input_path, timeout, "MarkItDown")
 
 
-def get_converter(extension: str) -> str | None:
-    """Return the converter name for a given extension, or None if unsupported."""
-    ext = extension.lower()
-    if ext in PANDOC_EXTENSIONS:
-        return "pandoc"
-    if ext == ".xlsx":
-        return "xlsx"
-    if ext == ".xls":
-        return "xls"
-    if ext in MARKITDOWN_EXTENSIONS or ext == ".doc":
-        return "markitdown"
-    return None
+def xls_to_markdown(input_path: str, timeout: int = DEFAULT_TIMEOUT) -> bytes:
+    """Convert a legacy .xls file to Markdown using python-calamine in a worker process.
 
+    xlrd 2.x rejects some .xls files with OLE2 FAT chain issues;
+    python-calamine (Rust-based) is more tolerant and faster.
+    """
+    return _run_in_worker(_calamine_worker, input_path, timeout, "XLS")
 
-def _check_password_protected(input_path: str, extension: str) -> None:
-    """Raise early if the file appears to be password-protected."""
-    ext = extension.lower()
-    try:
-        with open(input_path, 'rb') as f:
-            header = f.read(8)
-    except OSError:
-        return  # let the converter deal with unreadable files
-
-    if ext in _ZIP_BASED_EXTENSIONS and header.startswith(_OLE2_MAGIC):
-        # Password-protected Office files get encrypted into an OLE2 container,
-        # so a .xlsx/.pptx/.docx that starts with OLE2 magic instead of ZIP
-        # magic (PK) is almost certainly encrypted.  Detecting this upfront
-        # avoids the confusing "File is not a zip file" / "Can't find workbook
-        # in OLE2 compound document" errors from downstream parsers.
-        raise ValueError(
-            f"File appears to be password-protected (encrypted Office document)"
-        )
 
+def xlsx_to_markdown(input_path: str, timeout: int = DEFAULT_TIMEOUT) -> bytes:
+    """Convert an .xlsx file to Markdown using python-calamine in a worker process.
+
+    Calamine (Rust-based) is fast, tolerant of unusual styles/fills that
+    trip up openpyxl, and already used for .xls files.
+    """
+    return _run_in_worker(_calamine_worker, input_path, timeout, "XLSX")
 
-def _detect_doc_format(input_path: str) -> str:
-    """Sniff the actual format of a .doc file.
 
-    Returns 'rtf', 'ole2', or 'unknown'.
-    Many .doc files are actually RTF saved with a .doc extension.
-    True legacy Word documents use the OLE2 binary format.
+def _sniff(input_path: str) -> str:
+    """Identify a file by its magic bytes: 'ole2', 'zip', 'rtf' or 'unknown'.
+
+    Many .doc files are actually RTF saved with a .doc extension; true
+    legacy Word documents use the OLE2 binary format.
     """
+    # A bare fd and pread skip the buffered file object; O_CLOEXEC keeps the
+    # fd from leaking into converter subprocesses spawned meanwhile.
     try:
-        with open(input_path, 'rb') as f:
-            header = f.read(8)
+        fd = os.open(input_path, os.O_RDONLY | os.O_CLOEXEC)
+        try:
+            header = os.pread(fd, 4, 0)
+        finally:
+            os.close(fd)
     except OSError:
-        return 'unknown'
-    if header.startswith(_RTF_MAGIC):
-        return 'rtf'
-    if header.startswith(_OLE2_MAGIC):
-        return 'ole2'
-    return 'unknown'
+        return 'unknown'  # let the converter deal with unreadable files
+    return _MAGIC_FORMATS.get(header, 'unknown')
 
 
-def _convert_doc(input_path: str, timeout: int = DEFAULT_TIMEOUT) -> str:
+def _looks_encrypted(input_path: str, ext: str) -> bool:
+    """Whether a ZIP-based Office file is really an encrypted OLE2 container."""
+    # Password-protected Office files get encrypted into an OLE2 container,
+    # so a .xlsx/.pptx/.docx that starts with OLE2 magic instead of ZIP
+    # magic (PK) is almost certainly encrypted.  Detecting this upfront
+    # avoids the confusing "File is not a zip file" / "Can't find workbook
+    # in OLE2 compound document" errors from downstream parsers.
+    return ext in _ZIP_BASED_EXTENSIONS and _sniff(input_path) == 'ole2'
+
+
+def _check_password_protected(input_path: str, extension: str) -> None:
+    """Raise early if the file appears to be password-protected."""
+    if _looks_encrypted(input_path, extension.lower()):
+        raise ValueError(_ENCRYPTED_MESSAGE)
+
+
+# (name for logging, converter) pairs tried in order for non-RTF .doc files,
+# keyed by sniffed format.  antiword (purpose-built for .doc) goes first for
+# unknown files too: WinWord 1/2 and Mac Word 4/5 binaries have no OLE2 header
+# but antiword still reads them.
+_DOC_FALLBACKS = {
+    'ole2': (
+        ("antiword", antiword_to_markdown),
+        ("MarkItDown", markitdown_to_markdown),
+        ("Pandoc", pandoc_to_markdown),
+    ),
+    'unknown': (
+        ("antiword", antiword_to_markdown),
+        ("MarkItDown", markitdown_to_markdown),
+        ("Pandoc", pandoc_to_markdown),
+    ),
+}
+
+
+def _convert_doc(input_path: str, timeout: int = DEFAULT_TIMEOUT) -> bytes:
     """Convert a .doc file with format detection and fallback.
 
     .doc files can be RTF (Pandoc handles well) or OLE2 binary Word
     (MarkItDown may handle).  We sniff the content and try the best
     converter first, falling back to the other if it fails.
     """
-    fmt = _detect_doc_format(input_path)
+    fmt = _sniff(input_path)
 
     if fmt == 'rtf':
         # RTF masquerading as .doc — Pandoc handles this natively
         logger.info("[Converter] .doc is RTF, using Pandoc")
         return pandoc_to_markdown(input_path, timeout=timeout)
 
-    # OLE2 binary or unknown — try antiword first (purpose-built for .doc),
-    # then MarkItDown, then Pandoc as final fallback.
-    if shutil.which("antiword"):
-        logger.info("[Converter] .doc is %s format, trying antiword", fmt)
+    # OLE2 binary or unknown — try each converter for the sniffed format in turn
+    for name, fn in _DOC_FALLBACKS.get(fmt, _DOC_FALLBACKS['unknown']):
+        if name == "antiword" and not _ANTIWORD_PATH:
+            continue
+        logger.info("[Converter] .doc is %s format, trying %s", fmt, name)
         try:
-            return antiword_to_markdown(input_path, timeout=timeout)
+            return fn(input_path, timeout=timeout)
         except RuntimeError as e:
-            logger.warning("[Converter] antiword failed for .doc: %s", e)
-
-    logger.info("[Converter] .doc is %s format, trying MarkItDown", fmt)
-    try:
-        return markitdown_to_markdown(input_path, timeout=timeout)
-    except RuntimeError as e:
-        logger.warning("[Converter] MarkItDown failed for .doc, trying Pandoc fallback: %s", e)
-    try:
-        return pandoc_to_markdown(input_path, timeout=timeout)
-    except RuntimeError:
-        pass
+            logger.warning("[Converter] %s failed for .doc: %s", name, e)
 
     raise RuntimeError(
         "Unable to convert .doc file. The legacy binary Word format (.doc) "
@@ -271,32 +452,59 @@ def _convert_doc(input_path: str, timeout: int = DEFAULT_TIMEOUT) -> str:
     )
 
 
-def convert(input_path: str, extension: str, timeout: int = DEFAULT_TIMEOUT) -> str:
-    """Route to the appropriate converter based on file extension."""
-    _check_password_protected(input_path, extension)
-    ext = extension.lower()
+def _convert_docx(input_path: str, timeout: int = DEFAULT_TIMEOUT) -> bytes:
+    """Convert .docx with Pandoc, falling back to MarkItDown if Pandoc runs out of heap."""
+    try:
+        return pandoc_to_markdown(input_path, timeout=timeout)
+    except RuntimeError as e:
+        if "Heap exhausted" in str(e):
+            logger.warning("[Converter] Pandoc heap exhausted for .docx, falling back to MarkItDown")
+            return markitdown_to_markdown(input_path, timeout=timeout)
+        raise
+
+
+# Extension -> (converter name for logging, conversion function).  .doc logs
+# its own choice once it has sniffed the file's real format.
+_DISPATCH = {ext: ("MarkItDown", markitdown_to_markdown) for ext in MARKITDOWN_EXTENSIONS}
+_DISPATCH.update({ext: ("Pandoc", pandoc_to_markdown) for ext in PANDOC_EXTENSIONS})
+_DISPATCH.update({
+    ".docx": ("Pandoc", _convert_docx),
+    ".doc": (None, _convert_doc),
+    ".xlsx": ("calamine", xlsx_to_markdown),
+    ".xls": ("calamine", xls_to_markdown),
+})
+
+# Converter names reported by get_converter(), keyed by dispatch function
+_CONVERTER_NAMES = {
+    pandoc_to_markdown: "pandoc",
+    _convert_docx: "pandoc",
+    markitdown_to_markdown: "markitdown",
+    xlsx_to_markdown: "xlsx",
+    xls_to_markdown: "xls",
+    _convert_doc: "doc",  # sniffed, then antiword -> MarkItDown -> Pandoc
+}
+
+
+@functools.lru_cache(maxsize=64)
+def get_converter(extension: str) -> str | None:
+    """Return the converter name for a given extension, or None if unsupported."""
+    entry = _DISPATCH.get(extension.lower())
+    return _CONVERTER_NAMES[entry[1]] if entry else None
 
-    if ext == ".doc":
-        return _convert_doc(input_path, timeout=timeout)
 
-    converter = get_converter(ext)
-    if converter == "pandoc":
-        logger.info("[Converter] Using Pandoc for %s", extension)
-        try:
-            return pandoc_to_markdown(input_path, timeout=timeout)
-        except RuntimeError as e:
-            if ext == ".docx" and "Heap exhausted" in str(e):
-                logger.warning("[Converter] Pandoc heap exhausted for %s, falling back to MarkItDown", extension)
-                return markitdown_to_markdown(input_path, timeout=timeout)
-            raise
-    elif converter == "xlsx":
-        logger.info("[Converter] Using calamine for %s", extension)
-        return xlsx_to_markdown(input_path, timeout=timeout)
-    elif converter == "xls":
-        logger.info("[Converter] Using calamine for %s", extension)
-        return xls_to_markdown(input_path, timeout=timeout)
-    elif converter == "markitdown":
-        logger.info("[Converter] Using MarkItDown for %s", extension)
-        return markitdown_to_markdown(input_path, timeout=timeout)
-    else:
+def convert(input_path: str, extension: str, timeout: int = DEFAULT_TIMEOUT) -> bytes:
+    """Route to the appropriate converter based on file extension.
+
+    Returns UTF-8 encoded Markdown, ready to send as a response body.
+    """
+    ext = extension.lower()
+    if ext not in MARKITDOWN_EXTENSIONS:
+        # MarkItDown/calamine workers check for encryption themselves
+        _check_password_protected(input_path, ext)
+    entry = _DISPATCH.get(ext)
+    if entry is None:
         raise ValueError(f"Unsupported extension: {extension}")
+    name, fn = entry
+    if name:
+        logger.info("[Converter] Using %s for %s", name, extension)
+    return fn(input_path, timeout=timeout)
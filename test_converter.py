@@ -1,39 +1,131 @@
+import asyncio
+import base64
+import errno
+import io
+import json
 import os
 import subprocess
-from unittest.mock import MagicMock, patch
+import threading
+import time
+import urllib.error
+import zipfile
+from unittest.mock import AsyncMock, MagicMock, patch
 
 import pytest
-from fastapi.testclient import TestClient
-
-from app import app, sanitize_filename, _queue_slots, MAX_CONCURRENT_CONVERSIONS, MAX_QUEUED_CONVERSIONS
+from fastapi import HTTPException
+
+import app as app_module
+from app import (
+    UPLOAD_DIR,
+    _acquire_conversion_slot,
+    _content_disposition_params,
+    _private_upload_dir,
+    _resolve_upload_name,
+    _wait_unless_disconnected,
+    sanitize_filename,
+)
 from converter import (
     MARKITDOWN_EXTENSIONS,
     PANDOC_EXTENSIONS,
     SUPPORTED_EXTENSIONS,
+    antiword_to_markdown,
     convert,
     get_converter,
-    antiword_to_markdown,
+    markitdown_to_markdown,
+    pandoc_stream_to_markdown,
+    pandoc_to_markdown,
+    xlsx_to_markdown,
+    _MAX_TAIL_LINES,
+    _DISPATCH,
+    _DOC_FALLBACKS,
+    _calamine_worker,
+    _convert_doc,
+    _extract_exception_message,
+    _markitdown_worker,
+    _run_in_worker,
 )
 
-client = TestClient(app)
+
+# An OLE2 compound-document header, padded past the 8 magic bytes
+OLE2_HEADER = bytes.fromhex("d0cf11e0a1b11ae1").ljust(108, b"\x00")
+
+# Request kwargs for a plain .docx upload; the content never reaches a real converter
+DOCX_UPLOAD = {
+    "files": {"file": ("test.docx", b"content", "application/octet-stream")},
+    "data": {"filename": "test.docx"},
+}
+
+
+def _ok(stdout: bytes) -> subprocess.CompletedProcess:
+    """A successful subprocess.run result with the given stdout."""
+    return subprocess.CompletedProcess([], returncode=0, stdout=stdout, stderr=b"")
+
+
+def _failed(stderr: bytes) -> subprocess.CompletedProcess:
+    """A subprocess.run result that exited 1 with the given stderr."""
+    return subprocess.CompletedProcess([], returncode=1, stdout=b"", stderr=stderr)
+
+
+def _pandoc_timeout() -> subprocess.TimeoutExpired:
+    """A fresh timeout for mocks to raise; a shared instance would pile up tracebacks."""
+    return subprocess.TimeoutExpired(cmd="pandoc", timeout=120)
+
+
+_XLSX_PARTS = {
+    "[Content_Types].xml": (
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    ),
+    "_rels/.rels": (
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="xl/workbook.xml" Type="http://schemas.openxmlformats.org'
+        '/officeDocument/2006/relationships/officeDocument"/></Relationships>'
+    ),
+    "xl/workbook.xml": (
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Sheet1" sheetId="1" r:id="rId1"/></sheets></workbook>'
+    ),
+    "xl/_rels/workbook.xml.rels": (
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="worksheets/sheet1.xml" Type="http://schemas.openxmlformats.org'
+        '/officeDocument/2006/relationships/worksheet"/></Relationships>'
+    ),
+}
+
+
+def _write_xlsx(path, sheet_data: str) -> None:
+    """Write a one-sheet .xlsx whose <sheetData> is the given XML."""
+    with zipfile.ZipFile(path, "w") as z:
+        for name, xml in _XLSX_PARTS.items():
+            z.writestr(name, xml)
+        z.writestr(
+            "xl/worksheets/sheet1.xml",
+            '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+            f"<sheetData>{sheet_data}</sheetData></worksheet>",
+        )
 
 
 # ── Extension routing tests ──────────────────────────────────────────────────
 
 class TestExtensionRouting:
-    @pytest.mark.parametrize("ext", sorted(PANDOC_EXTENSIONS))
-    def test_pandoc_extensions(self, ext):
-        assert get_converter(ext) == "pandoc"
-
-    @pytest.mark.parametrize("ext", sorted(MARKITDOWN_EXTENSIONS - {".xlsx", ".xls"}))
-    def test_markitdown_extensions(self, ext):
-        assert get_converter(ext) == "markitdown"
-
-    def test_xlsx_extension(self):
-        assert get_converter(".xlsx") == "xlsx"
-
-    def test_xls_extension(self):
-        assert get_converter(".xls") == "xls"
+    def test_extension_routing(self):
+        cases = [(ext, "pandoc") for ext in PANDOC_EXTENSIONS]
+        cases += [(ext, "markitdown") for ext in MARKITDOWN_EXTENSIONS - {".xlsx", ".xls"}]
+        cases += [(".xlsx", "xlsx"), (".xls", "xls"), (".doc", "doc")]
+        for ext, expected in cases:
+            assert get_converter(ext) == expected, ext
+
+    def test_every_supported_extension_is_routed(self):
+        assert _DISPATCH.keys() == SUPPORTED_EXTENSIONS
+        for ext in SUPPORTED_EXTENSIONS:
+            assert get_converter(ext) is not None, ext
 
     def test_unsupported_extension(self):
         assert get_converter(".zip") is None
@@ -44,9 +136,6 @@ class TestExtensionRouting:
         assert get_converter(".ppt") is None
         assert get_converter(".ods") is None
 
-    def test_legacy_binary_formats_use_markitdown(self):
-        assert get_converter(".doc") == "markitdown"
-
     def test_legacy_binary_formats_use_dedicated_converter(self):
         assert get_converter(".xls") == "xls"
 
@@ -55,11 +144,17 @@ class TestExtensionRouting:
         assert get_converter(".Xlsx") == "xlsx"
         assert get_converter(".PDF") == "markitdown"
 
+    def test_convert_dispatch_is_case_insensitive(self):
+        fake = MagicMock(return_value=b"# PDF")
+        with patch.dict("converter._DISPATCH", {".pdf": ("MarkItDown", fake)}):
+            assert convert("/fake/report.PDF", ".PDF") == b"# PDF"
+        fake.assert_called_once()
+
 
 # ── Health endpoint tests ────────────────────────────────────────────────────
 
 class TestHealthEndpoint:
-    def test_health_returns_200(self):
+    def test_health_returns_200(self, client):
         response = client.get("/health")
         assert response.status_code == 200
         data = response.json()
@@ -67,46 +162,102 @@ class TestHealthEndpoint:
         assert "pandoc" in data
         assert "markitdown" in data
 
-    def test_health_structure(self):
+    def test_health_structure(self, client):
         response = client.get("/health")
         data = response.json()
         assert isinstance(data["pandoc"], bool)
         assert isinstance(data["markitdown"], bool)
 
 
-# ── Filename sanitization tests ──────────────────────────────────────────────
+# ── Upload directory tests ───────────────────────────────────────────────────
 
-class TestFilenameSanitization:
-    def test_safe_filename(self):
-        assert sanitize_filename("document.docx") == "document.docx"
+class TestPrivateUploadDir:
+    def test_creates_owner_only_directory(self, tmp_path):
+        path = str(tmp_path / "uploads")
+        assert _private_upload_dir(path) == path
+        assert os.stat(path).st_mode & 0o777 == 0o700
 
-    def test_path_traversal_blocked(self):
-        result = sanitize_filename("../../etc/passwd")
-        assert ".." not in result
-        assert "/" not in result
+    def test_rejects_group_or_world_access(self, tmp_path):
+        path = tmp_path / "uploads"
+        path.mkdir()
+        path.chmod(0o755)
+        with pytest.raises(RuntimeError, match="mode 755"):
+            _private_upload_dir(str(path))
 
-    def test_strips_directory(self):
-        result = sanitize_filename("/some/path/file.pdf")
-        assert result == "file.pdf"
+    def test_rejects_symlink(self, tmp_path):
+        target = tmp_path / "elsewhere"
+        target.mkdir(mode=0o700)
+        (tmp_path / "uploads").symlink_to(target)
+        with pytest.raises(RuntimeError, match="not a directory"):
+            _private_upload_dir(str(tmp_path / "uploads"))
 
-    def test_unsafe_characters_replaced(self):
-        result = sanitize_filename("file name (1).docx")
-        assert " " not in result
-        assert "(" not in result
+
+# ── Filename sanitization tests ──────────────────────────────────────────────
+
+class TestFilenameSanitization:
+    @pytest.mark.parametrize("filename, expected", [
+        ("document.docx", "document.docx"),
+        ("../../etc/passwd", "passwd"),
+        ("/some/path/file.pdf", "file.pdf"),
+        ("file name (1).docx", "file_name__1_.docx"),
+        ("résumé 2024.docx", "r_sum__2024.docx"),
+    ], ids=["safe", "path-traversal", "directory", "unsafe-chars", "non-ascii"])
+    def test_sanitize(self, filename, expected):
+        assert sanitize_filename(filename) == expected
 
     def test_empty_raises(self):
         with pytest.raises(ValueError):
             sanitize_filename("")
 
 
+class TestResolveUploadName:
+    @pytest.mark.parametrize("form_name, cd_name, expected", [
+        ("report.DOCX", "", ("report.DOCX", ".docx")),
+        ("", "notes.odt", ("notes.odt", ".odt")),
+        ("form.pdf", "part.docx", ("form.pdf", ".pdf")),
+        ("my report.docx", "", ("my_report.docx", ".docx")),
+    ])
+    def test_resolves_name_and_extension(self, form_name, cd_name, expected):
+        assert _resolve_upload_name(form_name, cd_name) == expected
+
+    @pytest.mark.parametrize("form_name, expected_status", [
+        ("", 400),
+        ("/", 400),
+        ("test.zip", 415),
+        ("noext", 415),
+        (".docx", 415),
+    ])
+    def test_rejects(self, form_name, expected_status):
+        with pytest.raises(HTTPException) as exc_info:
+            _resolve_upload_name(form_name, "")
+        assert exc_info.value.status_code == expected_status
+
+
+class TestContentDisposition:
+    @pytest.mark.parametrize("cd, expected", [
+        (b'form-data; name="file"; filename="x.docx"', ("file", "x.docx")),
+        (b'form-data; NAME="file"; FILENAME="x.docx"', ("file", "x.docx")),
+        (b'form-data; name="file"; filename="Q1; final.docx"', ("file", "Q1; final.docx")),
+        (b'form-data; name="file"; filename="say \\"hi\\".docx"', ("file", 'say "hi".docx')),
+        (b'form-data; name=filename', ("filename", "")),
+        (b'form-data; name="file"; filename="a.docx"; x="; filename=b.pdf"', ("file", "a.docx")),
+        (b'form-data; name="file"; filename="C:\\Users\\me\\x.docx"', ("file", "x.docx")),
+    ], ids=[
+        "plain", "uppercase-params", "semicolon", "escaped-quote", "bare",
+        "param-inside-other-quoted-value", "ie-full-path",
+    ])
+    def test_params(self, cd, expected):
+        assert _content_disposition_params(cd) == expected
+
+
 # ── Convert endpoint tests ───────────────────────────────────────────────────
 
 class TestConvertEndpoint:
-    def test_missing_file_returns_400(self):
+    def test_missing_file_returns_400(self, client):
         response = client.post("/convert", data={"filename": "test.docx"})
         assert response.status_code == 400
 
-    def test_unsupported_extension_returns_415(self):
+    def test_unsupported_extension_returns_415(self, client):
         response = client.post(
             "/convert",
             files={"file": ("test.zip", b"fake content", "application/zip")},
@@ -114,186 +265,329 @@ class TestConvertEndpoint:
         )
         assert response.status_code == 415
 
-    def test_no_extension_returns_415(self):
+    def test_successful_pandoc_conversion(self, mock_convert, client):
+        mock_convert.return_value = b"# Hello World\n\nSome content."
+        response = client.post("/convert", **DOCX_UPLOAD)
+        assert response.status_code == 200
+        assert response.content == b"# Hello World\n\nSome content."
+        assert response.headers["content-type"] == "text/markdown; charset=utf-8"
+
+    @patch("app.pandoc_stream_to_markdown")
+    def test_stdin_format_streams_to_pandoc(self, mock_stream, mock_convert, client):
+        """Formats Pandoc reads from stdin skip the temp file and generic convert()."""
+        piped = []
+        mock_stream.side_effect = lambda stream, ext, timeout: piped.append((stream.read(), ext)) or b"# Notes"
         response = client.post(
             "/convert",
-            files={"file": ("noext", b"fake content", "application/octet-stream")},
-            data={"filename": "noext"},
+            files={"file": ("notes.txt", b"# Notes", "text/plain")},
+            data={"filename": "notes.txt"},
         )
-        assert response.status_code == 415
+        assert response.status_code == 200
+        assert response.text == "# Notes"
+        assert piped == [(b"# Notes", ".txt")]
+        mock_convert.assert_not_called()
+        assert _leftover_uploads() == []
+
+    @patch("app.MAX_UPLOAD_SIZE", 1024)
+    def test_oversized_content_length_returns_413(self, client, mock_convert):
+        response = client.post(
+            "/convert",
+            files={"file": ("big.docx", b"x" * (200 * 1024), "application/octet-stream")},
+        )
+        assert response.status_code == 413
+        mock_convert.assert_not_called()
 
-    @patch("app.convert")
-    def test_successful_pandoc_conversion(self, mock_convert):
-        mock_convert.return_value = "# Hello World\n\nSome content."
+    @patch("app.MAX_UPLOAD_SIZE", 1024)
+    def test_oversized_file_within_overhead_returns_413(self, client, mock_convert):
+        """Bodies under the Content-Length allowance are still capped while streaming."""
         response = client.post(
             "/convert",
-            files={"file": ("test.docx", b"fake docx content", "application/octet-stream")},
-            data={"filename": "test.docx"},
+            files={"file": ("big.docx", b"x" * 2048, "application/octet-stream")},
+        )
+        assert response.status_code == 413
+        mock_convert.assert_not_called()
+        assert _leftover_uploads() == []
+
+    @pytest.mark.parametrize("errno_, expected_status", [
+        (errno.ENOSPC, 507),
+        (errno.EIO, 500),
+    ], ids=["no-space", "io-error"])
+    def test_spool_write_error_is_a_server_error(self, errno_, expected_status, mock_convert, client):
+        """Failing to store the upload isn't a conversion failure (422)."""
+        spool = MagicMock()
+        spool.write.side_effect = OSError(errno_, os.strerror(errno_))
+        with patch("app._open_spool", return_value=(spool, None)):
+            response = client.post("/convert", **DOCX_UPLOAD)
+        assert response.status_code == expected_status
+        spool.close.assert_called()
+        mock_convert.assert_not_called()
+
+    def test_quoted_filename_with_semicolon(self, mock_convert, client):
+        """A ';' inside a quoted Content-Disposition filename doesn't split it."""
+        mock_convert.return_value = b"# Report"
+        response = client.post(
+            "/convert",
+            files={"file": ("Q1; final.docx", b"fake docx content", "application/octet-stream")},
         )
         assert response.status_code == 200
-        assert "Hello World" in response.text
-        assert response.headers["content-type"].startswith("text/markdown")
+        tmp_path, ext, _ = mock_convert.call_args.args
+        assert ext == ".docx"
+        assert tmp_path.endswith("-Q1__final.docx")
 
-    @patch("app.convert")
-    def test_successful_markitdown_conversion(self, mock_convert):
-        mock_convert.return_value = "| Col A | Col B |\n|---|---|\n| 1 | 2 |"
+    def test_successful_markitdown_conversion(self, mock_convert, client):
+        mock_convert.return_value = b"| Col A | Col B |\n|---|---|\n| 1 | 2 |"
         response = client.post(
             "/convert",
             files={"file": ("data.xlsx", b"fake xlsx content", "application/octet-stream")},
             data={"filename": "data.xlsx"},
         )
         assert response.status_code == 200
-        assert "Col A" in response.text
+        assert response.content == b"| Col A | Col B |\n|---|---|\n| 1 | 2 |"
 
-    @patch("app.convert")
-    def test_conversion_failure_returns_422(self, mock_convert):
+    def test_conversion_failure_returns_422(self, mock_convert, client):
         mock_convert.side_effect = RuntimeError("Corrupt file")
-        response = client.post(
-            "/convert",
-            files={"file": ("bad.docx", b"corrupt", "application/octet-stream")},
-            data={"filename": "bad.docx"},
-        )
+        response = client.post("/convert", **DOCX_UPLOAD)
         assert response.status_code == 422
 
-    @patch("app.convert")
-    def test_conversion_timeout_returns_504(self, mock_convert):
-        mock_convert.side_effect = subprocess.TimeoutExpired(cmd="pandoc", timeout=120)
-        response = client.post(
-            "/convert",
-            files={"file": ("slow.docx", b"content", "application/octet-stream")},
-            data={"filename": "slow.docx"},
-        )
+    def test_conversion_timeout_returns_504(self, mock_convert, client):
+        mock_convert.side_effect = _pandoc_timeout()
+        response = client.post("/convert", **DOCX_UPLOAD)
         assert response.status_code == 504
 
 
 # ── Temp file cleanup tests ─────────────────────────────────────────────────
 
-class TestTempFileCleanup:
-    @patch("app.convert")
-    def test_temp_files_cleaned_on_success(self, mock_convert):
-        mock_convert.return_value = "# Result"
-        response = client.post(
-            "/convert",
-            files={"file": ("test.docx", b"content", "application/octet-stream")},
-            data={"filename": "test.docx"},
-        )
-        assert response.status_code == 200
-        # Verify no leftover temp dirs with our test file
-        # (temp dirs are cleaned in finally block)
+def _leftover_uploads():
+    """Temp uploads written by this process that were not cleaned up."""
+    prefix = f"{os.getpid()}-"
+    return [n for n in os.listdir(UPLOAD_DIR) if n.startswith(prefix)]
 
-    @patch("app.convert")
-    def test_temp_files_cleaned_on_failure(self, mock_convert):
-        mock_convert.side_effect = RuntimeError("fail")
-        response = client.post(
-            "/convert",
-            files={"file": ("test.docx", b"content", "application/octet-stream")},
-            data={"filename": "test.docx"},
-        )
-        assert response.status_code == 422
-        # Temp dir should still be cleaned up via finally block
+
+class TestTempFileCleanup:
+    @pytest.mark.parametrize("outcome, expected_status", [
+        (b"# Result", 200),
+        (RuntimeError("fail"), 422),
+    ], ids=["success", "failure"])
+    def test_upload_removed_after_conversion(self, outcome, expected_status, mock_convert, client):
+        seen = []
+
+        def fake_convert(path, ext, timeout):
+            seen.append(os.path.exists(path))
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+
+        mock_convert.side_effect = fake_convert
+        response = client.post("/convert", **DOCX_UPLOAD)
+        assert response.status_code == expected_status
+        assert seen == [True]  # the converter got a real file...
+        assert _leftover_uploads() == []  # ...which is gone afterwards
 
 
 # ── Queue limit tests ───────────────────────────────────────────────────────
 
+@pytest.mark.xdist_group("queue")
 class TestQueueLimit:
-    @patch("app.convert")
-    def test_returns_429_when_queue_full(self, mock_convert):
+    def test_returns_429_when_queue_full(self, mock_convert, client, drained_queue):
         """When all queue slots are exhausted, new requests get 429."""
-        total_slots = MAX_CONCURRENT_CONVERSIONS + MAX_QUEUED_CONVERSIONS
-        # Drain all semaphore slots to simulate a full queue
-        for _ in range(total_slots):
-            _queue_slots._value -= 1
-        try:
+        response = client.post("/convert", **DOCX_UPLOAD)
+        assert response.status_code == 429
+        assert "queued" in response.json()["detail"].lower()
+        mock_convert.assert_not_called()
+
+    def test_accepts_request_when_queue_has_room(self, mock_convert, client):
+        """When queue has room, request should succeed normally."""
+        mock_convert.return_value = b"# OK"
+        response = client.post("/convert", **DOCX_UPLOAD)
+        assert response.status_code == 200
+        assert app_module._inflight == 0  # slot released after the request
+
+
+# ── Client disconnect tests ─────────────────────────────────────────────────
+
+class TestDisconnectHandling:
+    @staticmethod
+    def _request(disconnected):
+        request = MagicMock()
+        request.is_disconnected = AsyncMock(return_value=disconnected)
+        return request
+
+    def test_queued_request_aborts_on_disconnect(self):
+        """A request waiting for a busy slot gives up once the client is gone."""
+        async def scenario():
+            semaphore = asyncio.Semaphore(1)
+            await semaphore.acquire()
+            with patch("app.conversion_semaphore", semaphore):
+                acquired = await _acquire_conversion_slot(self._request(True))
+            return acquired, semaphore.locked()
+
+        acquired, still_locked = asyncio.run(scenario())
+        assert acquired is False
+        assert still_locked  # the holder's slot is untouched
+
+    def test_queued_request_wakes_when_slot_released(self):
+        async def scenario():
+            semaphore = asyncio.Semaphore(1)
+            await semaphore.acquire()
+            with patch("app.conversion_semaphore", semaphore):
+                waiter = asyncio.create_task(_acquire_conversion_slot(self._request(False)))
+                await asyncio.sleep(0)
+                semaphore.release()
+                return await asyncio.wait_for(waiter, timeout=1.0)
+
+        assert asyncio.run(scenario()) is True
+
+    def test_running_conversion_abandoned_on_disconnect(self):
+        async def scenario():
+            pending = asyncio.get_running_loop().create_future()
+            return await _wait_unless_disconnected(self._request(True), pending)
+
+        assert asyncio.run(scenario()) is False
+
+    @patch("app._wait_unless_disconnected", AsyncMock(return_value=False))
+    def test_abandoned_stdin_upload_closed_after_conversion(self, client):
+        """The upload stays open for a conversion still running after a 499."""
+        release = threading.Event()
+        streams, reads = [], []
+
+        def slow_stream(stream, ext, timeout):
+            streams.append(stream)
+            release.wait(5)
+            reads.append(stream.read())
+            return b"# Notes"
+
+        with patch("app.pandoc_stream_to_markdown", side_effect=slow_stream):
             response = client.post(
                 "/convert",
-                files={"file": ("test.docx", b"content", "application/octet-stream")},
-                data={"filename": "test.docx"},
+                files={"file": ("notes.txt", b"# Notes", "text/plain")},
+                data={"filename": "notes.txt"},
             )
-            assert response.status_code == 429
-            assert "queued" in response.json()["detail"].lower()
-        finally:
-            # Restore semaphore
-            for _ in range(total_slots):
-                _queue_slots._value += 1
-
-    @patch("app.convert")
-    def test_accepts_request_when_queue_has_room(self, mock_convert):
-        """When queue has room, request should succeed normally."""
-        mock_convert.return_value = "# OK"
-        response = client.post(
-            "/convert",
-            files={"file": ("test.docx", b"content", "application/octet-stream")},
-            data={"filename": "test.docx"},
-        )
-        assert response.status_code == 200
+            assert response.status_code == 499
+            release.set()
+            deadline = time.monotonic() + 5
+            while not (streams and streams[0].closed) and time.monotonic() < deadline:
+                time.sleep(0.01)
+        assert reads == [b"# Notes"]  # the worker could still read the upload...
+        assert streams[0].closed  # ...which was closed once it finished
 
 
 # ── Converter function unit tests ────────────────────────────────────────────
 
 class TestConverterFunctions:
-    @patch("converter.subprocess.run")
     def test_pandoc_success(self, mock_run):
-        mock_run.return_value = MagicMock(
-            returncode=0,
-            stdout=b"# Converted\n\nText content.",
-            stderr=b"",
-        )
-        from converter import pandoc_to_markdown
+        mock_run.return_value = _ok(b"# Converted\n\nText content.")
 
         result = pandoc_to_markdown("/tmp/test.docx")
-        assert "Converted" in result
+        assert result == b"# Converted\n\nText content."
         mock_run.assert_called_once()
         args = mock_run.call_args[0][0]
-        assert args[0] == "pandoc"
+        assert os.path.basename(args[0]) == "pandoc"
 
-    @patch("converter.subprocess.run")
     def test_pandoc_failure_raises(self, mock_run):
-        mock_run.return_value = MagicMock(
-            returncode=1,
-            stderr=b"pandoc: error reading file",
-        )
-        from converter import pandoc_to_markdown
+        mock_run.return_value = _failed(b"pandoc: error reading file")
 
         with pytest.raises(RuntimeError, match="Pandoc conversion failed"):
             pandoc_to_markdown("/tmp/bad.docx")
 
-    @patch("converter.subprocess.run")
     def test_pandoc_timeout_raises(self, mock_run):
-        mock_run.side_effect = subprocess.TimeoutExpired(cmd="pandoc", timeout=120)
-        from converter import pandoc_to_markdown
+        mock_run.side_effect = _pandoc_timeout()
 
         with pytest.raises(subprocess.TimeoutExpired):
             pandoc_to_markdown("/tmp/slow.docx", timeout=120)
 
-    @patch("converter.subprocess.run")
-    def test_markitdown_success(self, mock_run):
+    def test_pandoc_stream_pipes_stdin(self, mock_run):
+        mock_run.return_value = _ok(b"Hello")
+
+        stream = io.BytesIO(b"{\\rtf1 Hello}")
+        result = pandoc_stream_to_markdown(stream, ".RTF")
+        assert result == b"Hello"
+        args = mock_run.call_args[0][0]
+        assert args[args.index("-f") + 1] == "rtf"
+        assert mock_run.call_args[1]["stdin"] is stream
+
+    @patch("converter.urllib.request.urlopen")
+    def test_pandoc_server_used_when_running(self, mock_urlopen, mock_run, tmp_path):
+        """With a pandoc server running, conversions are POSTed to it instead of the CLI."""
+        mock_urlopen.return_value.__enter__.return_value.read.return_value = b"# Served"
+        f = tmp_path / "doc.docx"
+        f.write_bytes(b"PK\x03\x04docx")
+
+        with patch("converter._pandoc_server", MagicMock()):
+            result = pandoc_to_markdown(str(f))
+        assert result == b"# Served"
+        payload = json.loads(mock_urlopen.call_args[0][0].data)
+        assert payload["from"] == "docx"
+        assert base64.b64decode(payload["text"]) == b"PK\x03\x04docx"
+        mock_run.assert_not_called()
+
+    @patch("converter.urllib.request.urlopen")
+    def test_pandoc_server_unreachable_falls_back_to_cli(self, mock_urlopen, mock_run):
+        mock_urlopen.side_effect = urllib.error.URLError(ConnectionRefusedError())
+        mock_run.return_value = _ok(b"# From CLI")
+
+        with patch("converter._pandoc_server", MagicMock(poll=MagicMock(return_value=None))):
+            result = pandoc_stream_to_markdown(io.BytesIO(b"# From CLI"), ".txt")
+        assert result == b"# From CLI"
+        mock_run.assert_called_once()
+
+    @patch("converter._run_in_worker")
+    def test_markitdown_success(self, mock_worker):
         expected_md = "| A | B |\n|---|---|\n| 1 | 2 |"
-        mock_run.return_value = subprocess.CompletedProcess(
-            [], returncode=0, stdout=expected_md.encode("utf-8"), stderr=b"",
-        )
+        mock_worker.return_value = expected_md.encode("utf-8")
 
-        from converter import markitdown_to_markdown
         result = markitdown_to_markdown("/tmp/data.xlsx")
-        assert "| A | B |" in result
+        assert result == expected_md.encode("utf-8")
+        assert mock_worker.call_args[0][:2] == (_markitdown_worker, "/tmp/data.xlsx")
+
+    def test_worker_error_raises_clean_message(self, tmp_path):
+        with pytest.raises(RuntimeError, match="XLSX conversion failed: .*No such file"):
+            xlsx_to_markdown(str(tmp_path / "missing.xlsx"))
+
+    def test_calamine_skips_leading_empty_area(self, tmp_path):
+        """A sheet whose data starts at C3 renders from C3, like to_python() does."""
+        f = tmp_path / "offset.xlsx"
+        _write_xlsx(f, (
+            '<row r="3"><c r="C3" t="inlineStr"><is><t>h1</t></is></c><c r="D3"><v>2.5</v></c></row>'
+            '<row r="4"><c r="C4" t="inlineStr"><is><t>a</t></is></c></row>'
+            '<row r="5"><c r="E5" t="inlineStr"><is><t>z</t></is></c></row>'
+        ))
+        assert bytes(_calamine_worker(str(f))) == (
+            b"## Sheet1\n"
+            b"| h1 | 2.5 |  |\n"
+            b"| --- | --- | --- |\n"
+            b"| a |  |  |\n"
+            b"|  |  | z |\n"
+        )
+
+    def test_exception_message_tail_is_capped(self):
+        stderr = b"Traceback (most recent call last):\n  File \"x.py\"\nFileConversionException: failed\n"
+        stderr += b"".join(b"  converter %d failed\n" % i for i in range(200))
+        message = _extract_exception_message(stderr)
+        assert message.splitlines()[0] == "failed"
+        assert len(message.splitlines()) == 1 + _MAX_TAIL_LINES
+
+    def test_worker_timeout_raises(self, tmp_path):
+        # Opening a FIFO for reading blocks until a writer shows up, so the
+        # worker hangs in-process and killing it leaves nothing behind
+        fifo = tmp_path / "never-written"
+        os.mkfifo(fifo)
+        with pytest.raises(subprocess.TimeoutExpired):
+            _run_in_worker(open, str(fifo), 0.2, "Fifo")
 
-    @patch("converter.subprocess.run")
     def test_antiword_success(self, mock_run):
-        mock_run.return_value = MagicMock(
-            returncode=0,
-            stdout=b"Hello from a .doc file",
-            stderr=b"",
-        )
+        mock_run.return_value = _ok(b"Hello from a .doc file")
         result = antiword_to_markdown("/tmp/test.doc")
-        assert "Hello from a .doc file" in result
+        assert result == b"Hello from a .doc file"
         args = mock_run.call_args[0][0]
-        assert args[0] == "antiword"
+        assert os.path.basename(args[0]) == "antiword"
+
+    def test_antiword_output_normalised_to_utf8(self, mock_run):
+        mock_run.return_value = _ok(b"caf\xe9")
+        result = antiword_to_markdown("/tmp/latin1.doc")
+        assert result.decode("utf-8") == "caf\ufffd"
 
-    @patch("converter.subprocess.run")
     def test_antiword_failure_raises(self, mock_run):
-        mock_run.return_value = MagicMock(
-            returncode=1,
-            stderr=b"I can't open the file",
-        )
+        mock_run.return_value = _failed(b"I can't open the file")
         with pytest.raises(RuntimeError, match="antiword conversion failed"):
             antiword_to_markdown("/tmp/bad.doc")
 
@@ -301,51 +595,41 @@ class TestConverterFunctions:
 # ── Password-protected file detection tests ──────────────────────────────────
 
 class TestPasswordProtectedDetection:
-    OLE2_HEADER = b'\xD0\xCF\x11\xE0\xA1\xB1\x1A\xE1' + b'\x00' * 100
-
-    def test_encrypted_xlsx_returns_415(self, tmp_path):
+    def test_encrypted_xlsx_returns_415(self, client):
         """An OLE2-wrapped .xlsx (password-protected) should be rejected with 415."""
-        f = tmp_path / "encrypted.xlsx"
-        f.write_bytes(self.OLE2_HEADER)
         response = client.post(
             "/convert",
-            files={"file": ("encrypted.xlsx", f.read_bytes(), "application/octet-stream")},
+            files={"file": ("encrypted.xlsx", OLE2_HEADER, "application/octet-stream")},
             data={"filename": "encrypted.xlsx"},
         )
         assert response.status_code == 415
         assert "password-protected" in response.json()["detail"].lower()
 
-    def test_encrypted_pptx_returns_415(self, tmp_path):
-        f = tmp_path / "encrypted.pptx"
-        f.write_bytes(self.OLE2_HEADER)
+    def test_encrypted_pptx_returns_415(self, client):
         response = client.post(
             "/convert",
-            files={"file": ("encrypted.pptx", f.read_bytes(), "application/octet-stream")},
+            files={"file": ("encrypted.pptx", OLE2_HEADER, "application/octet-stream")},
             data={"filename": "encrypted.pptx"},
         )
         assert response.status_code == 415
         assert "password-protected" in response.json()["detail"].lower()
 
-    def test_encrypted_docx_returns_415(self, tmp_path):
-        f = tmp_path / "encrypted.docx"
-        f.write_bytes(self.OLE2_HEADER)
+    def test_encrypted_docx_returns_415(self, client):
         response = client.post(
             "/convert",
-            files={"file": ("encrypted.docx", f.read_bytes(), "application/octet-stream")},
+            files={"file": ("encrypted.docx", OLE2_HEADER, "application/octet-stream")},
             data={"filename": "encrypted.docx"},
         )
         assert response.status_code == 415
         assert "password-protected" in response.json()["detail"].lower()
 
-    def test_normal_xls_not_flagged(self, tmp_path):
+    def test_normal_xls_not_flagged(self, client):
         """OLE2-based .xls files are legitimate and should not be blocked."""
-        f = tmp_path / "normal.xls"
-        f.write_bytes(self.OLE2_HEADER)
         # .xls is OLE2 natively, so it shouldn't be flagged as password-protected.
         # It will fail conversion for other reasons (fake content), but not with 415.
         response = client.post(
             "/convert",
-            files={"file": ("normal.xls", f.read_bytes(), "application/octet-stream")},
+            files={"file": ("normal.xls", OLE2_HEADER, "application/octet-stream")},
             data={"filename": "normal.xls"},
         )
         assert response.status_code != 415
@@ -355,123 +639,82 @@ class TestPasswordProtectedDetection:
 
 class TestDocConversion:
     RTF_CONTENT = b'{\\rtf1 Hello World}'
-    OLE2_HEADER = b'\xD0\xCF\x11\xE0\xA1\xB1\x1A\xE1' + b'\x00' * 100
 
     @patch("converter.pandoc_to_markdown")
-    def test_rtf_doc_routes_to_pandoc(self, mock_pandoc):
+    def test_rtf_doc_routes_to_pandoc(self, mock_pandoc, tmp_path):
         """A .doc file that is actually RTF should go straight to Pandoc."""
-        mock_pandoc.return_value = "# Hello World"
-        from converter import _convert_doc
-        import tempfile, os
-        tmp = tempfile.NamedTemporaryFile(suffix=".doc", delete=False)
-        try:
-            tmp.write(self.RTF_CONTENT)
-            tmp.close()
-            result = _convert_doc(tmp.name)
-            assert "Hello World" in result
-            mock_pandoc.assert_called_once()
-        finally:
-            os.unlink(tmp.name)
-
-    @patch("converter.pandoc_to_markdown")
-    @patch("converter.markitdown_to_markdown")
-    def test_ole2_doc_tries_markitdown_first(self, mock_markitdown, mock_pandoc):
-        """An OLE2 .doc should try MarkItDown first (when antiword is unavailable)."""
-        mock_markitdown.return_value = "# Converted via MarkItDown"
-        from converter import _convert_doc
-        import tempfile, os
-        tmp = tempfile.NamedTemporaryFile(suffix=".doc", delete=False)
-        try:
-            tmp.write(self.OLE2_HEADER)
-            tmp.close()
-            with patch("converter.shutil.which", return_value=None):
-                result = _convert_doc(tmp.name)
-            assert "MarkItDown" in result
-            mock_markitdown.assert_called_once()
-            mock_pandoc.assert_not_called()
-        finally:
-            os.unlink(tmp.name)
-
-    @patch("converter.pandoc_to_markdown")
-    @patch("converter.markitdown_to_markdown")
-    def test_ole2_doc_falls_back_to_pandoc(self, mock_markitdown, mock_pandoc):
-        """When MarkItDown fails for OLE2 .doc, should fall back to Pandoc (antiword unavailable)."""
-        mock_markitdown.side_effect = RuntimeError("MarkItDown failed")
-        mock_pandoc.return_value = "# Converted via Pandoc"
-        from converter import _convert_doc
-        import tempfile, os
-        tmp = tempfile.NamedTemporaryFile(suffix=".doc", delete=False)
-        try:
-            tmp.write(self.OLE2_HEADER)
-            tmp.close()
-            with patch("converter.shutil.which", return_value=None):
-                result = _convert_doc(tmp.name)
-            assert "Pandoc" in result
-            mock_markitdown.assert_called_once()
-            mock_pandoc.assert_called_once()
-        finally:
-            os.unlink(tmp.name)
+        mock_pandoc.return_value = b"# Hello World"
+        f = tmp_path / "test.doc"
+        f.write_bytes(self.RTF_CONTENT)
+        result = _convert_doc(str(f))
+        assert result == b"# Hello World"
+        mock_pandoc.assert_called_once()
 
-    @patch("converter.pandoc_to_markdown")
-    @patch("converter.markitdown_to_markdown")
-    def test_ole2_doc_both_fail_gives_clear_error(self, mock_markitdown, mock_pandoc):
-        """When all converters fail for .doc, error should suggest re-saving as .docx."""
-        mock_markitdown.side_effect = RuntimeError("MarkItDown failed")
-        mock_pandoc.side_effect = RuntimeError("Pandoc failed")
-        from converter import _convert_doc
-        import tempfile, os
-        tmp = tempfile.NamedTemporaryFile(suffix=".doc", delete=False)
-        try:
-            tmp.write(self.OLE2_HEADER)
-            tmp.close()
-            with patch("converter.shutil.which", return_value=None):
+    @staticmethod
+    def _mock_chain(**outcomes):
+        """Patch the .doc fallback chains, swapping each converter for a mock.
+
+        Keyword names are the chain's converter names; each outcome is a
+        return value or an exception for that mock to raise.
+        """
+        mocks = {
+            name: MagicMock(side_effect=outcome) if isinstance(outcome, Exception)
+            else MagicMock(return_value=outcome)
+            for name, outcome in outcomes.items()
+        }
+        chains = {
+            fmt: tuple((name, mocks[name]) for name, _ in chain)
+            for fmt, chain in _DOC_FALLBACKS.items()
+        }
+        return patch.dict("converter._DOC_FALLBACKS", chains), mocks
+
+    @pytest.mark.parametrize("antiword_path, antiword, markitdown, pandoc, expected", [
+        (None, None, b"# Converted via MarkItDown", None, b"# Converted via MarkItDown"),
+        (None, None, RuntimeError("MarkItDown failed"), b"# Converted via Pandoc", b"# Converted via Pandoc"),
+        (None, None, RuntimeError("MarkItDown failed"), RuntimeError("Pandoc failed"), None),
+        ("/usr/bin/antiword", b"Converted via antiword", None, None, b"Converted via antiword"),
+        (
+            "/usr/bin/antiword", RuntimeError("antiword failed"), b"# Converted via MarkItDown", None,
+            b"# Converted via MarkItDown",
+        ),
+    ], ids=[
+        "markitdown-first-without-antiword",
+        "markitdown-fails-falls-back-to-pandoc",
+        "all-fail-suggests-docx",
+        "antiword-first",
+        "antiword-fails-falls-back-to-markitdown",
+    ])
+    def test_ole2_doc_fallback_chain(self, antiword_path, antiword, markitdown, pandoc, expected, tmp_path):
+        """OLE2 .doc tries antiword (if installed), then MarkItDown, then Pandoc.
+
+        Each converter outcome is a return value, an exception it raises, or
+        None when the chain must stop before reaching it.
+        """
+        f = tmp_path / "test.doc"
+        f.write_bytes(OLE2_HEADER)
+        outcomes = {"antiword": antiword, "MarkItDown": markitdown, "Pandoc": pandoc}
+        chain_patch, mocks = self._mock_chain(**outcomes)
+        with patch("converter._ANTIWORD_PATH", antiword_path), chain_patch:
+            if expected is None:
                 with pytest.raises(RuntimeError, match="re-saving as .docx"):
-                    _convert_doc(tmp.name)
-        finally:
-            os.unlink(tmp.name)
-
-    @patch("converter.pandoc_to_markdown")
-    @patch("converter.markitdown_to_markdown")
-    @patch("converter.antiword_to_markdown")
-    def test_ole2_doc_tries_antiword_first(self, mock_antiword, mock_markitdown, mock_pandoc):
-        """When antiword is available, it should be tried first for OLE2 .doc."""
-        mock_antiword.return_value = "Converted via antiword"
-        from converter import _convert_doc
-        import tempfile, os
-        tmp = tempfile.NamedTemporaryFile(suffix=".doc", delete=False)
-        try:
-            tmp.write(self.OLE2_HEADER)
-            tmp.close()
-            with patch("converter.shutil.which", return_value="/usr/bin/antiword"):
-                result = _convert_doc(tmp.name)
-            assert "antiword" in result
-            mock_antiword.assert_called_once()
-            mock_markitdown.assert_not_called()
-            mock_pandoc.assert_not_called()
-        finally:
-            os.unlink(tmp.name)
-
-    @patch("converter.pandoc_to_markdown")
-    @patch("converter.markitdown_to_markdown")
-    @patch("converter.antiword_to_markdown")
-    def test_ole2_doc_antiword_fails_falls_to_markitdown(self, mock_antiword, mock_markitdown, mock_pandoc):
-        """When antiword fails, should fall back to MarkItDown."""
-        mock_antiword.side_effect = RuntimeError("antiword failed")
-        mock_markitdown.return_value = "# Converted via MarkItDown"
-        from converter import _convert_doc
-        import tempfile, os
-        tmp = tempfile.NamedTemporaryFile(suffix=".doc", delete=False)
-        try:
-            tmp.write(self.OLE2_HEADER)
-            tmp.close()
-            with patch("converter.shutil.which", return_value="/usr/bin/antiword"):
-                result = _convert_doc(tmp.name)
-            assert "MarkItDown" in result
-            mock_antiword.assert_called_once()
-            mock_markitdown.assert_called_once()
-            mock_pandoc.assert_not_called()
-        finally:
-            os.unlink(tmp.name)
+                    _convert_doc(str(f))
+            else:
+                assert _convert_doc(str(f)) == expected
+        for name, outcome in outcomes.items():
+            assert mocks[name].call_count == (outcome is not None), name
+
+    def test_unknown_doc_tries_antiword_first(self, tmp_path):
+        """Word binaries without OLE2 magic (e.g. WinWord 2) still go to antiword first."""
+        f = tmp_path / "old.doc"
+        f.write_bytes(b"\xdb\xa5" + bytes(126))
+        chain_patch, mocks = self._mock_chain(
+            antiword=b"Converted via antiword", MarkItDown=None, Pandoc=None,
+        )
+        with patch("converter._ANTIWORD_PATH", "/usr/bin/antiword"), chain_patch:
+            result = _convert_doc(str(f))
+        assert result == b"Converted via antiword"
+        mocks["MarkItDown"].assert_not_called()
+        mocks["Pandoc"].assert_not_called()
 
 
 class TestDocxConversion:
@@ -484,9 +727,9 @@ class TestDocxConversion:
     def test_docx_falls_back_to_markitdown_on_heap_exhaustion(self, mock_pandoc, mock_markitdown):
         """When Pandoc heap-exhausts on a .docx, should fall back to MarkItDown."""
         mock_pandoc.side_effect = RuntimeError("Pandoc conversion failed: pandoc: Heap exhausted;")
-        mock_markitdown.return_value = "# Fallback result"
+        mock_markitdown.return_value = b"# Fallback result"
         result = convert("/fake/test.docx", ".docx")
-        assert result == "# Fallback result"
+        assert result == b"# Fallback result"
         mock_pandoc.assert_called_once()
         mock_markitdown.assert_called_once()
 
@@ -494,6 +737,5 @@ class TestDocxConversion:
     def test_docx_non_heap_error_still_raises(self, mock_pandoc):
         """Non-heap Pandoc errors for .docx should not trigger fallback."""
         mock_pandoc.side_effect = RuntimeError("Pandoc conversion failed: some other error")
-        import pytest
         with pytest.raises(RuntimeError, match="some other error"):
             convert("/fake/test.docx", ".docx")